@@ -6,10 +6,30 @@
 # University of Oregon
 #
 
+from importlib.util import find_spec
 import logging
+import numpy as np
 import pandas as pd
+from pathlib import Path
 import re
 
+# Maximum number of block summaries saved by SNPFilter.apply
+
+SUMMARY_CACHE_SIZE = 16
+
+# Columns read from the peaks file (the unnamed index column written by the
+# peak finder is not used)
+
+PEAK_COLUMNS = [
+    'chrom_id', 'chromosome', 'position', 'hmm_state1', 'base_geno', 
+    'reference', 'ref_reads', 'variant', 'var_reads', 'blk_id',
+]
+
+# If pyarrow is installed it is used to parse the CSV file and to save a
+# Parquet copy that is read instead of the CSV file the next time
+
+HAVE_PYARROW = find_spec('pyarrow') is not None
+
 # Chromosome lengths
 
 chr_length = {
@@ -21,6 +41,122 @@ chr_length = {
     6: 17739129,
 }
 
+# The same lengths in an array indexed by chromosome number, so the lengths
+# for all SNPs can be looked up with a single NumPy gather
+
+chr_length_table = np.array([chr_length.get(i, 0) for i in range(max(chr_length)+1)])
+
+def cached_parquet(fn, reader, columns):
+    '''
+    Read a data file, using a Parquet copy if there is one.  The copy has the same 
+    name as the data file plus a `.pq` extension, and it's used as long as it is
+    newer than the data file.  Otherwise the data file is read by `reader` and,
+    if pyarrow is available, the frame is saved in a new copy (if the copy can't
+    be written the frame is still returned).
+
+    Arguments:
+      fn:  the name of the data file
+      reader:  a function that is passed the file name and returns a data frame
+      columns:  the names of the columns to read from the copy
+
+    Returns:
+      a data frame with the specified columns
+    '''
+    if not HAVE_PYARROW:
+        return reader(fn)
+    cache = Path(str(fn) + '.pq')
+    if cache.exists() and cache.stat().st_mtime >= Path(fn).stat().st_mtime:
+        logging.info(f'reading {cache}')
+        return pd.read_parquet(cache, columns=columns)
+    df = reader(fn)
+    try:
+        df.to_parquet(cache, compression='zstd', index=False)
+    except OSError as err:
+        logging.warning(f'not saving {cache}: {err}')
+    return df
+
+def read_peaks(fn):
+    '''
+    Read the columns used by the filters from a peaks file.  If the file name
+    ends with .parquet it is read directly.  Otherwise it's a CSV file, parsed 
+    by pyarrow if it is available, and a Parquet copy is saved for later calls
+    (see `cached_parquet`).
+
+    Arguments:
+      fn:  the name of the file written by the peak finder
+
+    Returns:
+      a data frame with the columns in PEAK_COLUMNS
+    '''
+    if str(fn).endswith('.parquet'):
+        return pd.read_parquet(fn, columns=PEAK_COLUMNS)
+    engine = 'pyarrow' if HAVE_PYARROW else 'c'
+    return cached_parquet(fn, lambda f: pd.read_csv(f, engine=engine, usecols=PEAK_COLUMNS), PEAK_COLUMNS)
+
+def chromosome_slices(df):
+    '''
+    Sort a data frame by chromosome ID and make a table that has the location
+    of each chromosome in the sorted frame.  Rows for a chromosome can then be
+    fetched with `iloc` (a slice, not a copy) instead of a group lookup.
+
+    Arguments:
+      df:  a data frame with a `chrom_id` column
+
+    Returns:
+      the sorted frame and a dictionary that maps a chromosome ID to a pair
+      of row numbers (start and end of the chromosome's slice)
+    '''
+    df = df.sort_values('chrom_id', kind='stable').reset_index(drop=True)
+    codes, names = pd.factorize(df.chrom_id)
+    bounds = np.r_[0, np.flatnonzero(np.diff(codes)) + 1, len(df)]
+    slices = { name: (bounds[i], bounds[i+1]) for i, name in enumerate(names) }
+    return df, slices
+
+def block_stats(df, by):
+    '''
+    Compute the size, start, end, and mean location of each block.  The peak
+    finder writes all the SNPs in a block on consecutive lines, so a block is a
+    run of rows with the same key, and the size, start, and end are computed for
+    all blocks at once by a NumPy `reduceat` that starts a new min or max at the
+    first row of each run.  The mean location is computed by pandas, grouping by
+    run number, since pandas uses compensated summation and a plain sum of the 
+    locations would differ from `groupby(by).agg` in the last digits.
+
+    Arguments:
+      df:  a data frame with SNPs
+      by:  the names of the columns that identify a block
+
+    Returns:
+      a data frame indexed by block, with the same columns and row order as
+      the equivalent `groupby(by).agg`, or None if the rows for a block are 
+      not contiguous
+    '''
+    if len(df) == 0:
+        return None
+    new_run = np.zeros(len(df), dtype=bool)
+    new_run[0] = True
+    for col in by:
+        # compare category codes instead of the strings they stand for
+        k = df[col].cat.codes.to_numpy() if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].to_numpy()
+        new_run[1:] |= k[1:] != k[:-1]
+    starts = np.flatnonzero(new_run)
+    keys = [df[col].array[starts] for col in by]
+    if len(by) == 1:
+        index = pd.Index(keys[0], name=by[0])
+    else:
+        index = pd.MultiIndex.from_arrays(keys, names=by)
+    if not index.is_unique:
+        return None
+    pos = df.position.to_numpy()
+    sizes = np.diff(np.append(starts, len(df)))
+    stats = pd.DataFrame({
+        'blk_size': sizes,
+        'blk_start': np.minimum.reduceat(pos, starts),
+        'blk_end': np.maximum.reduceat(pos, starts),
+        'blk_loc': df.location.groupby(np.cumsum(new_run), sort=False).mean().to_numpy(),
+    }, index=index)
+    return stats if index.is_monotonic_increasing else stats.sort_index()
+
 class SNPFilter:
     """
     A SNPFilter object is the main interface to the SNP data.  After creating the object
@@ -46,21 +182,33 @@ class SNPFilter:
         self._max_length = 10000
         self._coverage = 0
         self._matched = False
-        self._groups = None
+        self._slices = None
+        self._summaries = {}
 
     def load_data(self, fn):
         '''
-        Read the SNP data from a CSV file.  Add two new columns (chromosome length and 
-        relative SNP location) used in summaries. SNPs are grouped by chromosome ID and
-        the groups are saved in an instance variable.
+        Read the SNP data from a CSV file (see `read_peaks`).  Add three new 
+        columns (chromosome length, relative SNP location, and coverage, the total
+        number of reads) used in summaries and filters, convert chromosome IDs and
+        the other string columns to categories, and convert integer columns to the
+        smallest type that holds their values.  SNPs are sorted by chromosome ID
+        and the location of each chromosome is saved in an instance variable.
 
         Arguments:
           fn: name of CSV file
         '''
-        self._snps = pd.read_csv(fn).rename(columns={'Unnamed: 0': 'SNP'})
-        self._snps['chr_length'] = self._snps.chromosome.map(lambda n: chr_length[n])
-        self._snps['location'] = self._snps.position / self._snps.chr_length
-        self._groups = self._snps.groupby('chrom_id')
+        snps = read_peaks(fn)
+        for col in ['chrom_id', 'base_geno', 'hmm_state1', 'reference', 'variant']:
+            snps[col] = snps[col].astype('category')
+        snps['chr_length'] = chr_length_table[snps.chromosome.to_numpy()]
+        snps['location'] = snps.position.to_numpy() / snps.chr_length.to_numpy()
+        snps['coverage'] = snps.ref_reads.to_numpy(dtype=np.int64) + snps.var_reads.to_numpy(dtype=np.int64)
+        # the integer columns fit in 32 bits or less; downcasting after the new
+        # columns are made means sums can't overflow a small type
+        for col in ['chromosome', 'position', 'ref_reads', 'var_reads', 'blk_id', 'chr_length', 'coverage']:
+            snps[col] = pd.to_numeric(snps[col], downcast='integer')
+        self._snps, self._slices = chromosome_slices(snps)
+        self._summaries = {}
 
     def has_chromosome_block(self, chr_id):
         '''
@@ -69,7 +217,7 @@ class SNPFilter:
         Arguments:
           chr_id:  the name of the chromosome to look for.
         '''
-        return chr_id in self._groups.groups
+        return chr_id in self._slices
     
     @property
     def chromosome(self):
@@ -126,56 +274,102 @@ class SNPFilter:
         If a chromosome ID is passed apply the filters to that chromosome only,
         otherwise use the complete set of all SNPs.
 
-        The first step is to make a subset of SNPs that pass the coverage and match
-        filters.  The resulting frame is then grouped by block.
+        The first step, done by `_summarize`, makes a subset of SNPs that pass the 
+        coverage and match filters, groups them by block, and makes a summary frame
+        based on the size and location of each block.  The result of this step is
+        saved, keyed by the settings it depends on, so if only the block size or
+        block length settings change it doesn't have to be repeated.
 
-        The second step makes a separate summary frame based on size and location of
-        each block.  This frame is then filtered using the block size and block length
-        filters.
+        The second step filters the summary frame using the block size and block 
+        length filters.
 
         Arguments:
           chr_id:  the ID of the chromosome to use
 
+        Returns:
+          groups:  the blocks in the filtered chromosome
+          summary:  a data frame with size, length, and location of each block
+        '''
+        key = (chr_id, self._chromosome if chr_id is None else None, self._matched, self._coverage)
+        if key not in self._summaries:
+            if len(self._summaries) >= SUMMARY_CACHE_SIZE:
+                del self._summaries[next(iter(self._summaries))]
+            self._summaries[key] = self._summarize(chr_id)
+        groups, sf = self._summaries[key]
+
+        min_size = sf.blk_size >= self._min_size
+        max_size = sf.blk_size <= self._max_size
+        min_len = sf.blk_len >= self._min_length
+        max_len = sf.blk_len <= self._max_length
+
+        sf = sf[min_size & max_size & min_len & max_len]
+        logging.info(f'summary has {sf.blk_size.sum()} SNPs in {len(sf)} blocks')
+
+        return groups, sf
+
+    def _summarize(self, chr_id):
+        '''
+        Helper method for `apply`.  When filtering all chromosomes the pattern is
+        compared to chromosome names (not every SNP) and the rows for the chromosomes
+        that match are found in the table of chromosome locations.
+
+        Each of the match and coverage filters makes a 
+        boolean mask, the masks are combined with a logical AND, and the frame is 
+        indexed once with the combined mask.  The SNPs that pass are grouped by
+        block and the per-block values are computed by `block_stats` (or, if the
+        SNPs in a block aren't on consecutive rows, in a single `agg` call).
+
+        Arguments:
+          chr_id:  the ID of the chromosome to use (None for all chromosomes that match the pattern)
+
         Returns:
           groups:  the blocks in the filtered chromosome
           summary:  a data frame with size, length, and location of each block
         '''
         if chr_id is None:
-            df = self._snps[self._snps.chrom_id.map(lambda s: bool(re.match(self._chromosome,s)))]
+            pattern = re.compile(self._chromosome)
+            selected = np.zeros(len(self._snps), dtype=bool)
+            for name, (start, end) in self._slices.items():
+                if pattern.match(name):
+                    selected[start:end] = True
+            df = self._snps[selected]
         else:
-            df = self._groups.get_group(chr_id)
+            start, end = self._slices[chr_id]
+            df = self._snps.iloc[start:end]
 
         logging.info(f'Filtering {len(df)} SNPs')
 
+        mask = np.ones(len(df), dtype=bool)
+
         if self._matched:
-            df = df[df.base_geno == df.hmm_state1]
-            logging.info(f'{len(df)} match')
+            mask &= df.base_geno.to_numpy() == df.hmm_state1.to_numpy()
+            logging.info(f'{mask.sum()} match')
 
         if self._coverage:
-            df = df[df.var_reads + df.ref_reads > self._coverage]
-            logging.info(f'{len(df)} have coverage > {self._coverage}')
+            mask &= df.coverage.to_numpy() > self._coverage
+            logging.info(f'{mask.sum()} have coverage > {self._coverage}')
+
+        if not mask.all():
+            df = df[mask]
    
-        if chr_id is None:
-            groups = df.groupby(['chrom_id', 'blk_id'])
-        else:
-            groups = df.groupby('blk_id')
-        logging.info(f'{len(groups)} groups')
-
-        sf = pd.concat(
-            [
-                groups.size().rename('blk_size'), 
-                (groups.max('position') - groups.min('position')).position.rename('blk_len'), 
-                groups.mean('location').location.rename('blk_loc'),
-            ],
-            axis=1
-        )
-        min_size = sf.blk_size >= self._min_size
-        max_size = sf.blk_size <= self._max_size
-        min_len = sf.blk_len >= self._min_length
-        max_len = sf.blk_len <= self._max_length
+        by = ['chrom_id', 'blk_id'] if chr_id is None else ['blk_id']
+        # the groups are only used to look up blocks by key, so they don't have to be sorted
+        groups = df.groupby(by if len(by) > 1 else by[0], sort=False, observed=True)
 
-        sf = sf[min_size & max_size & min_len & max_len]
-        logging.info(f'summary has {sf.blk_size.sum()} SNPs in {len(sf)} blocks')
+        stats = block_stats(df, by)
+        if stats is None:
+            stats = groups.agg(
+                blk_size = ('position', 'size'),
+                blk_start = ('position', 'min'),
+                blk_end = ('position', 'max'),
+                blk_loc = ('location', 'mean'),
+            ).sort_index()
+        logging.info(f'{len(stats)} groups')
+        sf = pd.DataFrame({
+            'blk_size': stats.blk_size,
+            'blk_len': stats.blk_end - stats.blk_start,
+            'blk_loc': stats.blk_loc,
+        })
 
         return groups, sf
-    
\ No newline at end of file
+    
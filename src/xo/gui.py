@@ -9,22 +9,134 @@
 #  $ xo gui OPTS
 #
 
+import asyncio
 import io
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import panel as pn
 import numpy as np
 import logging
 
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from matplotlib.colors import CSS4_COLORS as colors
-from matplotlib.collections import PatchCollection
-from matplotlib.patches import Rectangle, Circle
+from matplotlib.colors import to_rgba_array
+from matplotlib.collections import PolyCollection, EllipseCollection
 
-from xo.filters import SNPFilter
+from xo.filters import SNPFilter, chromosome_slices, cached_parquet
 
 pn.extension('tabulator')
 
 SIDEBAR_WIDTH = 350
+VIEW_CACHE_SIZE = 5
+INTERVAL_COLUMNS = ['chrom_id', 'start', 'length', 'hmm_state']
+
+def read_intervals(fn):
+    '''
+    Read the interval data.  If the file name ends with .parquet the file is
+    read with pyarrow, and only the columns used by the GUI are loaded, otherwise
+    the file should be a gzipped pickle of the original data frame.  The columns
+    used by the GUI are saved in a Parquet copy that is read by later calls
+    (see `cached_parquet`).
+
+    Arguments:
+      fn:  the name of the intervals file
+
+    Returns:
+      a data frame with the columns in INTERVAL_COLUMNS
+    '''
+    if str(fn).endswith('.parquet'):
+        return pd.read_parquet(fn, columns=INTERVAL_COLUMNS)
+    return cached_parquet(fn, lambda f: pd.read_pickle(f, compression='gzip')[INTERVAL_COLUMNS], INTERVAL_COLUMNS)
+
+def convert_to_parquet(path_in, path_out):
+    '''
+    Make a Parquet version of an intervals file.  The conversion only needs to be
+    done once; after that the GUI can be started with the name of the Parquet
+    file, which loads much faster than the pickled data frame.  Requires pyarrow.
+
+    Arguments:
+      path_in:  the name of a gzipped pickle file with interval data
+      path_out:  the name of the Parquet file to write
+    '''
+    intervals = pd.read_pickle(path_in, compression='gzip')
+    intervals.to_parquet(path_out, compression='zstd', index=False)
+
+def make_palette(pcolor, default='lightgray'):
+    '''
+    Make a palette for coloring patches based on the values in a column.  A palette
+    is a pair: a categorical type with the names in `pcolor` as categories and a 
+    table of RGBA colors, where row `i` is the color for category `i`.  There is
+    an extra row at the end of the table for the default color.
+
+    Arguments:
+      pcolor:  a dictionary that associates column values with color names
+      default:  the color to use for values not in the dictionary
+
+    Returns:
+      the categorical type and color table
+    '''
+    return pd.CategoricalDtype(list(pcolor)), to_rgba_array(list(pcolor.values()) + [default])
+
+def palette_colors(col, palette):
+    '''
+    Look up the colors for all the values in a column.  The values are converted 
+    to category codes and the codes are used to index the palette's color table.  
+    Values that are not categories have code -1, which selects the default color 
+    in the last row of the table.
+
+    Arguments:
+      col:  a Series with the values to color
+      palette:  a categorical type and color table made by `make_palette`
+
+    Returns:
+      an array of RGBA colors, one row for each value in the column
+    '''
+    dtype, table = palette
+    return table[pd.Categorical(col, dtype=dtype).codes]
+
+hmm_palette = make_palette({
+    'CB4856': 'dodgerblue',
+    'N2': 'indianred',
+})
+
+geno_palette = make_palette({
+    'CB4856': 'dodgerblue',
+    'N2': 'indianred',
+    'uCB4856': 'lightsteelblue',
+    'uN2': 'lightpink',
+    'unknown': 'lightgray',
+    'het': 'palegoldenrod',
+})
+
+def figure_to_png(fig):
+    '''
+    Render a Matplotlib figure to a PNG image, using the same settings as the
+    Matplotlib panes in the GUI (72 dpi, tight bounding box).  The figures are
+    independent of each other so this function can be called from worker threads.
+
+    Arguments:
+      fig:  the figure to render
+
+    Returns:
+      the bytes of the PNG image
+    '''
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=72, bbox_inches='tight')
+    return buf.getvalue()
+
+def figures_to_png(figs):
+    '''
+    Render a list of figures to PNG images, using a pool of threads.
+
+    Arguments:
+      figs:  the figures to render
+
+    Returns:
+      a list with the bytes of each image
+    '''
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(figure_to_png, figs))
 
 class BlockSizeFilterWidget(pn.widgets.IntRangeSlider):
     """
@@ -196,6 +308,13 @@ class PeakViewerApp(pn.template.BootstrapTemplate):
         self.download_pane = pn.GridBox(self.download_button, height=200, width=SIDEBAR_WIDTH)
         self.download_button.visible = False
 
+        # figures are drawn by the Agg backend and reused for each display; they
+        # are closed as far as pyplot is concerned (see _block_figure)
+        self.chromosome_figure = plt.subplots(figsize=(12,1))
+        plt.close(self.chromosome_figure[0])
+        self.block_figures = []
+        self.display_lock = asyncio.Lock()
+
         self.attach_callbacks()
 
         chr_tab = pn.Column(
@@ -215,6 +334,8 @@ class PeakViewerApp(pn.template.BootstrapTemplate):
             ('Chromosome', chr_tab),
             ('Summary', summ_tab),
         )
+        self.display_pending = False
+        self.tabs.param.watch(self.tab_cb, ['active'])
 
         self.sidebar.append(
             pn.Column(
@@ -255,123 +376,280 @@ class PeakViewerApp(pn.template.BootstrapTemplate):
           args:  command line arguments 
         '''
         logging.info('loading interval data')
-        self.intervals = pd.read_pickle(args.intervals, compression='gzip').groupby('chrom_id')
-        self.clist = list(self.intervals.groups.keys())
+        intervals = read_intervals(args.intervals)
+        for col in ['chrom_id', 'hmm_state']:
+            intervals[col] = intervals[col].astype('category')
+        for col in ['start', 'length']:
+            intervals[col] = pd.to_numeric(intervals[col], downcast='integer')
+        self.intervals, self.chr_slices = chromosome_slices(intervals)
+        self.clist = list(self.chr_slices.keys())
         self.cmap = { name: i for i, name in enumerate(self.clist)}
         logging.info('loading peak data')
         self.filter.load_data(args.peaks)
+        self.view_cache = {}
+        self.chromosome_images = {}
 
         # setting a value in the chromosome name widget triggers an update
         # to the graphic to display the first chromosome
         self.chr_index = 0
         self.chromosome_id.value = self.clist[self.chr_index]
 
-    def display_chromosome(self):
+    async def display_chromosome(self):
         '''
         Update the chromosome display.  Called whenever the chromosome ID changes.  Shows
         a set of rectangular patches where the color is based on the region identified by 
         the HMM.  Below that is a grid with one row for each block of SNPs identifed by
         the peak finder.
+
+        This is a coroutine so the server can handle other widget events while the
+        figures are being rendered:  the images are made by worker threads, and the
+        event loop runs while it waits for them.  Displays share the figures used
+        for drawing, so a lock makes sure only one display is made at a time.
+        Callbacks should use `pn.state.execute` to run it.
+
+        If the chromosome tab is not showing the display is not made; it will be
+        made when the tab is selected (see `tab_cb`).
+
+        The displays for the most recently viewed chromosomes are saved (along with
+        the widgets and frames used by the block grid), so going back to a chromosome
+        with the same filter settings just puts the saved display back in the tab.
+        '''
+        if self.tabs.active != 0:
+            self.display_pending = True
+            return
+        self.display_pending = False
+        async with self.display_lock:
+            chr_id = self.chromosome_id.value
+            key = self._view_key(chr_id)
+            if key in self.view_cache:
+                view, grid = self.view_cache.pop(key)
+                self.view_cache[key] = (view, grid)
+                if grid is not None:
+                    self.block_buttons, self.block_frames, self.block_rows, self.block_text, self.block_snps = grid
+                self._replace_last(self.tabs[0], view)
+                return
+            # filter before the first await so the display matches the key
+            has_blocks = self.filter.has_chromosome_block(chr_id)
+            if has_blocks:
+                self.blocks, self.summary = self.filter.apply(chr_id)
+            image = await asyncio.to_thread(self._chromosome_image, chr_id)
+            parts = [pn.pane.PNG(image)]
+            grid = None
+            if has_blocks:
+                # self._make_dots()
+                parts.append(await self._make_grid())
+                grid = (self.block_buttons, self.block_frames, self.block_rows, self.block_text, self.block_snps)
+            view = pn.Column(*parts)
+            if len(self.view_cache) >= VIEW_CACHE_SIZE:
+                del self.view_cache[next(iter(self.view_cache))]
+            self.view_cache[key] = (view, grid)
+            self._replace_last(self.tabs[0], view)
+
+    def _chromosome_image(self, chr_id):
+        '''
+        Return a PNG image of the intervals in a chromosome.  The image does not
+        depend on the filter settings, so it is made the first time a chromosome 
+        is displayed and saved in a dictionary indexed by chromosome ID.
+
+        Arguments:
+          chr_id:  the ID of the chromosome to draw
+        '''
+        if chr_id not in self.chromosome_images:
+            start, end = self.chr_slices[chr_id]
+            chrom = self.intervals.iloc[start:end]
+            fig, ax = self.chromosome_figure
+            ax.cla()
+            ax.set_frame_on(False)
+            ax.set_yticks([])
+            ax.set_xticks(ticks=np.linspace(0,20000000,5), labels=[f'{int(n*20)}Mbp' for n in np.linspace(0,1,5)])
+            ax.xaxis.set_ticks_position('top')
+            # the axis limits are fixed, so skip updating the data limits
+            for coll in self._make_patches(chrom, ax):
+                ax.add_collection(coll, autolim=False)
+            ax.set_xlim(0,20000000)
+            ax.set_ylim(0,2000000)
+            self.chromosome_images[chr_id] = figure_to_png(fig)
+        return self.chromosome_images[chr_id]
+
+    def _replace_last(self, layout, obj):
+        '''
+        Replace the last item in a layout.  The new list of objects is assigned in a 
+        single step, and events are held until the assignment is done, so the browser 
+        gets one update instead of one for removing the old item and another for 
+        adding the new one.
+
+        Arguments:
+          layout:  the Column (or other list-like layout) to update
+          obj:  the new last item
         '''
-        chr_id = self.chromosome_id.value
-        chrom = self.intervals.get_group(chr_id)
-        rects = PatchCollection(self._make_patches(chrom), match_original=True)
-        fig, ax = plt.subplots(figsize=(12,1))
-        plt.box(False)
-        plt.yticks([])
-        plt.xticks(ticks=np.linspace(0,20000000,5), labels=[f'{int(n*20)}Mbp' for n in np.linspace(0,1,5)])
-        ax.xaxis.set_ticks_position('top')
-        ax.add_collection(rects)
-        plt.xlim(0,20000000)
-        plt.ylim(0,2000000)
-        plt.close(fig)
-        graphic = pn.Column(pn.pane.Matplotlib(fig, dpi=72, tight=True))
-        if self.filter.has_chromosome_block(chr_id):
-            self.blocks, self.summary = self.filter.apply(chr_id)
-            # self._make_dots()
-            grid = self._make_grid()
-            graphic.append(grid)
-        self.tabs[0].pop(-1)
-        self.tabs[0].append(graphic)
-
-    def _make_patches(self, df):
-        '''
-        Create a horizontal bar as a collection of rectangular patches, with one
-        patch for each row in the data frame.  The rows have the starting coordinates
-        lengths, and HMM states of chromosome regions, used to define the width and
-        color of a patch.
-        '''
-        pcolor = {
-            'CB4856': 'dodgerblue',
-            'N2': 'indianred'
-        }
-        res = []
-        for _, r in df.iterrows():
-            c = pcolor.get(r.hmm_state) or 'lightgray'
-            res.append(Rectangle((r.start,500000), r.length, 1000000, color=c))
-            res.append(Circle((r.start,750000), 50000, color='black'))
-        return res
+        with pn.io.hold():
+            layout.objects = layout.objects[:-1] + [obj]
+
+    def _view_key(self, chr_id):
+        '''
+        Make the key used to save the display of a chromosome: the chromosome ID
+        and the current filter settings.
+
+        Arguments:
+          chr_id:  the ID of the chromosome
+        '''
+        return (
+            chr_id, 
+            self.filter.size_range, 
+            self.filter.length_range, 
+            self.filter.coverage, 
+            self.filter.matched,
+        )
+
+    def _make_patches(self, df, ax):
+        '''
+        Create a horizontal bar made up of rectangles, with one rectangle for each
+        row in the data frame, and a marker at the start of each rectangle.  The rows 
+        have the starting coordinates, lengths, and HMM states of chromosome regions, 
+        used to define the width and color of a rectangle.
 
-    def _make_grid(self):
+        The rectangles are drawn by a single PolyCollection and the markers by a single
+        EllipseCollection, with coordinates computed from the data frame columns.
+
+        Arguments:
+          df:  the intervals for a chromosome
+          ax:  the Axes the collections will be drawn in
+
+        Returns:
+          a list of collections to add to the axes
+        '''
+        starts = df.start.to_numpy()
+        ends = starts + df.length.to_numpy()
+        state_colors = palette_colors(df.hmm_state, hmm_palette)
+        verts = np.empty((len(df),4,2), dtype=np.float32)
+        verts[:,0,0] = starts
+        verts[:,1,0] = ends
+        verts[:,2,0] = ends
+        verts[:,3,0] = starts
+        verts[:,:2,1] = 500000
+        verts[:,2:,1] = 1500000
+        rects = PolyCollection(verts, facecolors=state_colors, edgecolors=state_colors)
+        dots = EllipseCollection(
+            100000, 100000, 0, 
+            units='xy', 
+            offsets=np.column_stack([starts, np.full(len(df), 750000)]), 
+            offset_transform=ax.transData,
+            color='black',
+        )
+        return [rects, dots]
+
+    async def _make_grid(self):
         '''
         Make a Column object that has a collection of figures, one for each block 
         in a chromosome (saved in an instance var).  The figures are saved in a grid.
-        Below each figure is a text widget containing the data frame with the filtered 
-        SNPs in the block, i.e. the grid for a chromosome with N blocks as 2*N rows.
-        The frames are initially hidden.  The rows that have figures also have a toggle
-        button; clicking this button will show or hide the frame.
-        '''
-        pcolor = {
-            'CB4856': 'dodgerblue',
-            'N2': 'indianred',
-            'uCB4856': 'lightsteelblue',
-            'uN2': 'lightpink',
-            'unknown': 'lightgray',
-            'het': 'palegoldenrod',
-        }
-        self.block_buttons = {}
+        Below each figure is a row that will hold a table with the filtered SNPs 
+        in the block, i.e. the grid for a chromosome with N blocks as 2*N rows.
+        The rows that have figures also have a toggle button; clicking this button 
+        will show or hide the table.  The tables are not created here -- the row
+        numbers of the SNPs in each block are saved and a table is made the first 
+        time its button is clicked.
+
+        The positions and colors of all the SNPs are extracted once, and the values
+        for a block are selected with the row numbers found by the groupby object.  
+        The SNPs in a block are drawn by a single EllipseCollection.
+        The figures are converted to PNG images by a pool of threads after all of 
+        them have been drawn; this is a coroutine so the event loop can run while
+        the threads make the images.  The buttons in the grid being replaced can 
+        still be clicked while the images are made, so the dictionaries used by
+        `toggle_text_cb` are built in local variables and saved in the instance
+        variables after the images are done.
+        '''
+        buttons = {}
+        frames = {}
+        table_rows = {}
+        snps = self.blocks.obj
+        block_snps = snps[['position','base_geno','hmm_state1','reference','ref_reads','variant','var_reads']]
+        block_index = self.blocks.indices
+        all_positions = snps.position.to_numpy()
+        all_colors = palette_colors(snps.base_geno, geno_palette)
+        figs = []
+        summary = zip(self.summary.index, self.summary.blk_size.to_numpy(), self.summary.blk_len.to_numpy())
+        for k, (blk_id, size, length) in enumerate(summary):
+            idx = block_index[blk_id]
+            fig, ax = self._block_figure(k)
+            ax.set_frame_on(False)
+            ax.set_xlim(0,10)
+            ax.set_ylim(0,0.8)
+            ax.set_yticks([])
+            positions = all_positions[idx]
+            x0 = positions[0]
+            size = int(size)
+            length = int(length)
+            w = positions[-1] - x0
+            ax.set_xticks(ticks=np.linspace(0,10,5), labels=[f'{int(n*w)}bp' for n in np.linspace(0,1,5)])
+            fig.suptitle(f'Block #{blk_id}\nStart: {(x0/1000000):.1f}Mbp\nSize: {size} SNPs\nLength: {length}bp', x=0, y=0.75, size='medium',ha='left')
+            xs = (positions - x0) / length * 10 if length > 0 else np.zeros(len(positions))
+            dots = EllipseCollection(
+                0.2, 0.2, 0,
+                units='xy',
+                offsets=np.column_stack([xs, np.full(len(xs), 0.2)]),
+                offset_transform=ax.transData,
+                color=all_colors[idx],
+            )
+            ax.add_collection(dots, autolim=False)
+            figs.append(fig)
+            buttons[blk_id] = pn.widgets.Button(name='>', align='center', tags=[blk_id])
+            buttons[blk_id].on_click(self.toggle_text_cb)
+            frames[blk_id] = idx
+            table_rows[blk_id] = pn.Row()
+        images = await asyncio.to_thread(figures_to_png, figs)
+        self.block_buttons = buttons
+        self.block_frames = frames
+        self.block_rows = table_rows
         self.block_text = {}
-        g = pn.Column()
-        for blk_id, blk_stats in self.summary.iterrows():
-            block = self.blocks.get_group(blk_id)
-            fig, ax = plt.subplots(figsize=(10,0.8))
-            plt.box(False)
-            plt.xlim(0,10)
-            plt.ylim(0,0.8)
-            plt.yticks([])
-            x0 = block.iloc[0].position
-            size = int(blk_stats.blk_size)
-            length = int(blk_stats.blk_len)
-            w = block.iloc[-1].position - x0
-            plt.xticks(ticks=np.linspace(0,10,5), labels=[f'{int(n*w)}bp' for n in np.linspace(0,1,5)])
-            plt.suptitle(f'Block #{blk_id}\nStart: {(x0/1000000):.1f}Mbp\nSize: {size} SNPs\nLength: {length}bp', x=0, y=0.75, size='medium',ha='left')
-            res = []
-            for _, snp in block.iterrows():
-                p = ((snp.position - x0) / length) if length > 0 else 0
-                x = p*10
-                res.append(Circle((x,0.2),0.1,color=pcolor[snp.base_geno]))
-            dots = PatchCollection(res, match_original=True)
-            ax.add_collection(dots)
-            plt.close(fig)
-            self.block_buttons[blk_id] = pn.widgets.Button(name='>', align='center', tags=[blk_id])
-            self.block_buttons[blk_id].on_click(self.toggle_text_cb)
-            df = block[['position','base_geno','hmm_state1','reference','ref_reads','variant','var_reads']]
-            self.block_text[blk_id] = pn.pane.DataFrame(df, visible=False)
-            g.append(pn.Row(
-                self.block_buttons[blk_id],
-                pn.pane.Matplotlib(fig, dpi=72, tight=True),
+        self.block_snps = block_snps
+        rows = []
+        for blk_id, img in zip(buttons, images):
+            rows.append(pn.Row(
+                buttons[blk_id],
+                pn.pane.PNG(img),
                 styles={'background':'WhiteSmoke'},
             ))
-            g.append(pn.Row(self.block_text[blk_id]))
-        return g
+            rows.append(table_rows[blk_id])
+        return pn.Column(*rows)
     
+    def _block_figure(self, k):
+        '''
+        Return the figure and axes used to draw the k'th block in the grid.  Figures
+        are saved in a pool and reused (after clearing the axes) the next time a grid
+        is made, so a redraw doesn't have to allocate a new figure for each block.
+        Figures in the pool are closed as far as pyplot is concerned, so they
+        have to be drawn with the Axes and Figure methods, not the pyplot functions.
+
+        Arguments:
+          k:  the location of the block in the grid
+        '''
+        if k < len(self.block_figures):
+            fig, ax = self.block_figures[k]
+            ax.cla()
+        else:
+            fig, ax = plt.subplots(figsize=(10,0.8))
+            plt.close(fig)
+            self.block_figures.append((fig, ax))
+        return fig, ax
+
     def toggle_text_cb(self, e):
         '''
         Callback function invoked when a toggle button in the chromosome display is clicked.
         Toggles the visibility of the frame and updates the button name based on the new
-        visibility state.
+        visibility state.  The first time a button is clicked a Tabulator widget is made
+        to display the frame (Tabulator sends one page of rows at a time to the browser).
         '''
         i = e.obj.tags[0]
+        if i not in self.block_text:
+            self.block_text[i] = pn.widgets.Tabulator(
+                self.block_snps.iloc[self.block_frames[i]], 
+                pagination='remote', 
+                page_size=20, 
+                disabled=True, 
+                visible=False,
+            )
+            self.block_rows[i].append(self.block_text[i])
         self.block_text[i].visible = not self.block_text[i].visible
         self.block_buttons[i].name = '∨' if self.block_text[i].visible else '>'
 
@@ -381,7 +659,7 @@ class PeakViewerApp(pn.template.BootstrapTemplate):
         checkbox, etc) is activated.
         '''
         e.obj.filter_cb()
-        self.display_chromosome()        
+        pn.state.execute(self.display_chromosome)
 
     def change_chromosome_cb(self, e):
         '''
@@ -402,7 +680,16 @@ class PeakViewerApp(pn.template.BootstrapTemplate):
         if idx is not None:
             self.chr_index = idx
             self.chromosome_id.value = self.clist[idx]
-            self.display_chromosome()
+            pn.state.execute(self.display_chromosome)
+
+    def tab_cb(self, e):
+        '''
+        Callback function invoked when the user selects a tab.  If the chromosome
+        display was skipped (e.g. a filter changed while the summary tab was
+        showing) it is made now.
+        '''
+        if e.new == 0 and self.display_pending:
+            pn.state.execute(self.display_chromosome)
 
     histogram_params = {
         'Block Size': {
@@ -439,28 +726,43 @@ class PeakViewerApp(pn.template.BootstrapTemplate):
         },
     }
 
+    # Bin edges for histograms that have a fixed range (the others are
+    # based on the range of the data)
+
+    histogram_edges = {
+        name: np.linspace(*p['hist']['range'], p['hist']['bins']+1)
+        for name, p in histogram_params.items() if 'range' in p['hist']
+    }
+
     def summary_plot_cb(self, e):
         '''
         Callback function invoked when the user clicks the name of one of the 
         histograms in the summary tab.  All histograms have the same basic parameters,
         those that are specific to a type of data are defined in the
         `histogram_params` dictionary.
+
+        The counts are computed by NumPy, using the precomputed bin edges in
+        `histogram_edges` if there are any, and drawn as a bar chart.
         '''
         params = self.histogram_params[e.obj.name]
+        hist = params['hist']
         self.tabs[1].loading = True
         # self.filter.set_chromosome(self.chromosome_pattern.value)
         self.filter.chromosome = self.chromosome_pattern.value
-        self.summary_df = self.filter.summary()
+        _, self.summary_df = self.filter.apply()
+        bins = self.histogram_edges.get(e.obj.name, hist['bins'])
+        counts, edges = np.histogram(self.summary_df[params['col']].to_numpy(), bins=bins)
+        widths = np.diff(edges)
+        x = edges[:-1] if hist.get('align') == 'left' else edges[:-1] + widths/2
         fig, ax = plt.subplots(figsize=(7,5))
-        plt.hist(self.summary_df[params['col']], label=self.chromosome_pattern.value, **params['hist'])
+        ax.bar(x, counts, width=widths*hist.get('rwidth',1), label=self.chromosome_pattern.value)
         plt.title(params['title'])
         plt.xlabel(params['xlabel'])
         plt.ylabel(params['ylabel'])
         plt.legend(handlelength=0)
         plt.close(fig)
         self.tabs[1].loading = False
-        self.tabs[1].pop(-1)
-        self.tabs[1].append(pn.pane.Matplotlib(fig, dpi=72, tight=True))
+        self._replace_last(self.tabs[1], pn.pane.Matplotlib(fig, dpi=72, tight=True))
         self.download_button.visible = True
 
     def download_cb(self):
@@ -11,65 +11,375 @@
 # John Conery
 # University of Oregon
 
+from collections import deque
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from scipy.signal import find_peaks
 
 from rich.console import Console
 
-def extract_blocks(chromosome, max_block_size):
+from .filters import HAVE_PYARROW, chr_length
+
+# Numba is optional.  If it's not installed functions decorated with `njit` 
+# are plain Python functions.
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+# Change in the peak finder's signal for each HMM state, indexed by
+# category code + 1 (other, N2, CB4856)
+
+STATE_STEP = np.array([0, -1, 1])
+
+# Number of rows read at a time from a Parquet SNP file
+
+SNP_BATCH_SIZE = 1_000_000
+
+# Types of the integer columns in a Parquet output file.  `compact` picks the
+# smallest type for each chromosome separately, so the types are set here to
+# make the schema the same for every chromosome.
+
+PARQUET_TYPES = {
+    'chromosome': 'int32',
+    'position': 'int32',
+    'ref_reads': 'int32',
+    'var_reads': 'int32',
+    'blk_id': 'int64',
+}
+
+@njit(cache=True)
+def block_bounds(px, left_bases, right_bases, prominences, max_block_size):
     '''
-    Use `find_peaks` from the SciPy signal processing library to look for
-    sequences of SNPs.  Sequences that "stand out" are collected into a block,
-    represented by a data frame with a new column appended to hold the block ID.
+    Use the peak locations and properties returned by `find_peaks` to figure out 
+    where blocks start and end.  If a peak rises from its left base the block
+    is on the left side of the peak, otherwise the block is on the right side.
+    Blocks with more than `max_block_size` SNPs are skipped.
+
+    Compiled by Numba (if it is installed).
 
     Arguments:
-      chromosome:  a data frame where each row describes a SNP
+      px:  peak locations
+      left_bases, right_bases, prominences:  peak properties from `find_peaks`
       max_block_size:  the maximum number of SNPs to include in a block
 
     Returns:
-      a data frame containing all the SNPs in blocks.
+      three arrays with the starting row, ending row (exclusive), and ID of each block
     '''
-    signal = ((chromosome.hmm_state1 == 'CB4856').cumsum() - (chromosome.hmm_state1 == 'N2').cumsum()).to_numpy()
-    px, prop = find_peaks(signal, prominence=1)
-    blocks = []
+    starts = np.empty(len(px), dtype=np.int64)
+    ends = np.empty(len(px), dtype=np.int64)
+    ids = np.empty(len(px), dtype=np.int64)
+    n = 0
     for i in range(len(px)):
-        if prop['left_bases'][i] == px[i] - prop['prominences'][i]:
-            blk_start = prop['left_bases'][i] + 1
+        if left_bases[i] == px[i] - prominences[i]:
+            blk_start = left_bases[i] + 1
             blk_end = px[i]
         else:
             blk_start = px[i]+1
-            blk_end = prop['right_bases'][i]
+            blk_end = right_bases[i]
         if blk_end - blk_start > max_block_size:
             continue
-        df = chromosome.iloc[blk_start:blk_end+1]
-        blocks.append(df.assign(blk_id=i))
-    return pd.concat(blocks) if blocks else None
+        starts[n] = blk_start
+        ends[n] = blk_end + 1
+        ids[n] = i
+        n += 1
+    return starts[:n], ends[:n], ids[:n]
+
+def state_codes(chromosome):
+    '''
+    Convert the HMM states of the SNPs in a chromosome to category codes 
+    (-1 for other states, 0 for N2, 1 for CB4856).
+
+    Arguments:
+      chromosome:  a data frame where each row describes a SNP
+
+    Returns:
+      an array with one code for each SNP
+    '''
+    return pd.Categorical(chromosome.hmm_state1, categories=['N2', 'CB4856']).codes
+
+def find_blocks(codes, max_block_size):
+    '''
+    Use `find_peaks` from the SciPy signal processing library to look for
+    sequences of SNPs.  Sequences that "stand out" are collected into blocks.
+
+    The signal passed to `find_peaks` is a running sum that goes up by 1 at each 
+    CB4856 SNP and down by 1 at each N2 SNP.  The steps are found in a single pass
+    over the HMM state codes (see `state_codes`) by using the codes to index 
+    `STATE_STEP`.
+
+    The locations of the blocks are found by `block_bounds`.  The row numbers of
+    all the SNPs in blocks are computed with array operations (the offset of each 
+    block's first row is repeated once for each row in the block and added to a
+    running row count).
+
+    This function only needs the array of codes, not the full SNP frame, so
+    it's the part of the computation sent to worker processes.
+
+    Arguments:
+      codes:  the HMM state codes for the SNPs in a chromosome
+      max_block_size:  the maximum number of SNPs to include in a block
+
+    Returns:
+      two arrays, with the row number and block ID of each SNP in a block, or
+      None if there are no blocks
+    '''
+    signal = STATE_STEP[codes + 1].cumsum()
+    px, prop = find_peaks(signal, prominence=1)
+    starts, ends, ids = block_bounds(px, prop['left_bases'], prop['right_bases'], prop['prominences'], max_block_size)
+    if len(ids) == 0:
+        return None
+    sizes = ends - starts
+    idx = np.arange(sizes.sum()) + np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+    return idx, np.repeat(ids, sizes)
+
+def extract_blocks(chromosome, max_block_size):
+    '''
+    Find the blocks in a chromosome (see `find_blocks`).  Blocks are 
+    represented by a data frame with a new column appended to hold the block ID.
+    The frame is made in one step by indexing the chromosome frame with the 
+    full list of row numbers.
+
+    Arguments:
+      chromosome:  a data frame where each row describes a SNP
+      max_block_size:  the maximum number of SNPs to include in a block
+
+    Returns:
+      a data frame containing all the SNPs in blocks.
+    '''
+    found = find_blocks(state_codes(chromosome), max_block_size)
+    return make_blocks(chromosome, found)
+
+def make_blocks(chromosome, found):
+    '''
+    Make the data frame for the blocks found in a chromosome.
+
+    Arguments:
+      chromosome:  a data frame where each row describes a SNP
+      found:  the row numbers and block IDs returned by `find_blocks`
+
+    Returns:
+      a data frame containing all the SNPs in blocks, or None if there are no blocks
+    '''
+    if found is None:
+        return None
+    idx, ids = found
+    return chromosome.iloc[idx].assign(blk_id=ids)
+
+def compact(snps):
+    '''
+    Convert columns to compact types:  string columns have only a few distinct 
+    values and the numbers fit in 32 bits or less, so use categories and the
+    smallest integer types to cut the number of bytes scanned.
+
+    Arguments:
+      snps:  a frame with SNP data
+
+    Returns:
+      the frame, with new column types
+    '''
+    for col in ['chrom_id', 'hmm_state1', 'base_geno', 'reference', 'variant']:
+        snps[col] = snps[col].astype('category')
+    for col in ['position', 'ref_reads', 'var_reads']:
+        snps[col] = pd.to_numeric(snps[col], downcast='integer')
+    return snps
+
+def read_chromosomes(fn, batch_size=SNP_BATCH_SIZE):
+    '''
+    Generator that reads the SNP data one chromosome at a time.  If the file name
+    ends with .parquet the file is read in batches of `batch_size` rows, so only
+    a batch and the rows of the chromosome currently being read are in memory.
+    This requires the rows for each chromosome to be contiguous in the file
+    (which is the case for the files written by TIGER); a ValueError is raised
+    if more rows for a chromosome are found after the rows for another one.
+    Any other file name is read as a gzipped pickle.  In both cases chromosomes
+    are generated in the order they first appear in the file.
+
+    Arguments:
+      fn:  the name of the SNP file
+      batch_size:  the number of rows to read at a time from a Parquet file
+
+    Yields:
+      a chromosome ID and a frame with the SNPs for that chromosome
+    '''
+    if not str(fn).endswith('.parquet'):
+        snps = compact(pd.read_pickle(fn, compression='gzip'))
+        yield from snps.groupby('chrom_id', sort=False, observed=True)
+        return
+
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(fn)
+    # a RangeIndex isn't saved as a column, so batches would be numbered from 0;
+    # use the start and step saved in the metadata to number the rows instead,
+    # or number them from the start of the file if no index was saved
+    meta = pf.schema_arrow.pandas_metadata or {}
+    index_columns = meta.get('index_columns', [])
+    ranges = [c for c in index_columns if isinstance(c, dict)]
+    nrows = 0
+    pending = None
+    seen = set()
+
+    def chromosome(cname, df):
+        if cname in seen:
+            raise ValueError(f'rows for chromosome {cname} are not contiguous in {fn}')
+        seen.add(cname)
+        return cname, compact(df.copy())
+
+    for batch in pf.iter_batches(batch_size=batch_size):
+        df = batch.to_pandas()
+        if ranges:
+            first, step = ranges[0]['start'] + nrows * ranges[0]['step'], ranges[0]['step']
+            df.index = pd.RangeIndex(first, first + len(df) * step, step)
+        elif not index_columns:
+            df.index = pd.RangeIndex(nrows, nrows + len(df))
+        nrows += len(df)
+        if pending is not None:
+            df = pd.concat([pending, df])
+        ids = df.chrom_id.to_numpy()
+        bounds = [0, *(np.flatnonzero(ids[1:] != ids[:-1]) + 1)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield chromosome(ids[start], df.iloc[start:end])
+        pending = df.iloc[bounds[-1]:]
+    if pending is not None and len(pending):
+        yield chromosome(pending.chrom_id.iloc[0], pending)
+
+def arrow_csv_text(tbl):
+    '''
+    Return True if pyarrow's CSV writer will write a table the same way as
+    `DataFrame.to_csv`.  Every column has to be an integer or a string (including
+    categories of strings), and no string can have a comma, quote, or line break:
+    pandas puts quotes around those strings, but the writer used here doesn't
+    quote anything (it raises an exception instead).
+
+    Arguments:
+      tbl:  a pyarrow table
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pac
+    for col in tbl.columns:
+        t = col.type.value_type if pa.types.is_dictionary(col.type) else col.type
+        if pa.types.is_integer(t):
+            continue
+        if not (pa.types.is_string(t) or pa.types.is_large_string(t)):
+            return False
+        # for categories only the category names need to be checked
+        chunks = [c.dictionary for c in col.chunks] if pa.types.is_dictionary(col.type) else col.chunks
+        for values in chunks:
+            if pac.any(pac.match_substring_regex(values, '[,"\r\n]')).as_py():
+                return False
+    return True
+
+def write_blocks(fn, frames):
+    '''
+    Write blocks to the output file as they are generated, so only one
+    chromosome's blocks are in memory at a time.  If the file name ends with
+    .parquet the frames are written to a Parquet file (this requires pyarrow),
+    otherwise they are appended to a CSV file.  The integer columns in a Parquet
+    file have the types in PARQUET_TYPES, and if the output can't be written
+    the partial Parquet file is removed.  The CSV header is written by
+    pandas, but if pyarrow is installed the rows are written by pyarrow's CSV
+    writer, which is much faster than `to_csv`.  The two writers only produce
+    the same text for integers and strings that don't need quotes (they format
+    floats and Booleans differently), so other frames are written by pandas
+    (see `arrow_csv_text`).
+
+    Arguments:
+      fn:  the name of the output file
+      frames:  an iterable that produces data frames with blocks
+
+    Returns:
+      the number of records written
+    '''
+    nrecs = 0
+    if str(fn).endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for df in frames:
+                df = df.astype({col: t for col, t in PARQUET_TYPES.items() if col in df})
+                if writer is None:
+                    tbl = pa.Table.from_pandas(df)
+                    writer = pq.ParquetWriter(fn, tbl.schema)
+                else:
+                    tbl = pa.Table.from_pandas(df, schema=writer.schema)
+                writer.write_table(tbl)
+                nrecs += len(df)
+        except BaseException:
+            if writer is not None:
+                writer.close()
+                os.remove(fn)
+            raise
+        if writer is not None:
+            writer.close()
+    else:
+        if HAVE_PYARROW:
+            import pyarrow as pa
+            import pyarrow.csv as pc
+            options = pc.WriteOptions(include_header=False, quoting_style='none')
+        with open(fn, 'wb', buffering=1<<20) as f:
+            for df in frames:
+                if nrecs == 0:
+                    f.write(df.iloc[:0].to_csv().encode())
+                tbl = pa.Table.from_pandas(df, preserve_index=True) if HAVE_PYARROW else None
+                if tbl is not None and arrow_csv_text(tbl):
+                    # pyarrow puts the index after the data columns, move it to the front
+                    tbl = tbl.select([tbl.num_columns-1, *range(tbl.num_columns-1)])
+                    pc.write_csv(tbl, f, options)
+                else:
+                    df.to_csv(f, header=False, mode='wb')
+                nrecs += len(df)
+    return nrecs
 
 def peak_finder(args):
     '''
     Top level function for the `peaks` command.
-    Reads the SNP data, groups it by chromosome, and
-    calls `extract_blocks` for each chromosome.  The results are collected in
-    a data frame and written to a CSV file.
+    Reads the SNP data one chromosome at a time (see `read_chromosomes`) and
+    calls `find_blocks` for each chromosome.  Chromosomes are independent, so
+    they are sent to a pool of worker processes (only the HMM state codes are
+    sent; the frame with the blocks is made here, by `make_blocks`).  The number
+    of workers is the number of CPUs (or the number given on the command line)
+    but no more than the number of chromosomes, since the pool starts all of its
+    processes when the first task is submitted.  The number of chromosomes 
+    waiting for a worker is limited to the number of workers, so the SNPs for 
+    only a few chromosomes are in memory at any time.  The blocks found in a chromosome are
+    passed to `write_blocks` as soon as they are found, in the order the 
+    chromosomes were read.
 
     Arguments:
       args:  command line arguments from `argparse`
     '''
     console = Console()
+    nsnps = 0
+    workers = min(args.workers or os.cpu_count() or 1, len(chr_length))
+
+    def finished(cname, sf, future):
+        df = make_blocks(sf, future.result())
+        if df is None:
+            console.log(f'[red] no blocks in {cname}')
+        else:
+            console.log(f'{cname}: {len(sf)} SNPs {len(df)} in blocks')
+            yield df
+
+    def blocks(pool):
+        nonlocal nsnps
+        pending = deque()
+        for cname, sf in read_chromosomes(args.snps):
+            nsnps += len(sf)
+            pending.append((cname, sf, pool.submit(find_blocks, state_codes(sf), args.max_snps)))
+            if len(pending) > workers:
+                yield from finished(*pending.popleft())
+        while pending:
+            yield from finished(*pending.popleft())
+
     with console.status(f'Processing SNPs', spinner='aesthetic') as status:
         console.log(f'Reading {args.snps}')
-        snps = pd.read_pickle(args.snps, compression='gzip')
-        console.log(f'read {len(snps)} SNPs')
-        result = []
-        for cname, sf in snps.groupby('chrom_id'):
-            df = extract_blocks(sf, args.max_snps)
-            if df is None:
-                console.log(f'[red] no blocks in {cname}')
-            else:
-                console.log(f'{cname}: {len(sf)} SNPs {len(df)} in blocks')
-                result.append(df)
-        final = pd.concat(result)
         console.log(f'Writing to {args.output}')
-        final.to_csv(args.output)
-        console.log(f'Wrote {len(final)} records')
-
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            nrecs = write_blocks(args.output, blocks(pool))
+        console.log(f'read {nsnps} SNPs')
+        console.log(f'Wrote {nrecs} records')
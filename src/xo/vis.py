@@ -9,7 +9,7 @@ import logging
 import matplotlib.pyplot as plt
 import matplotlib
 
-import pandas as pd
+import numpy as np
 
 from .filters import SNPFilter
 
@@ -38,10 +38,75 @@ def set_params(filter, args):
       filter: the SNPFilter object that will do the filtering
       args: command line arguments
     '''
+    params = vars(args)
     for arg, attr in filter_params.items():
-        if val := vars(args).get(arg):
+        if (val := params.get(arg)) is not None:
             setattr(filter, attr, val)
 
+def histogram(data, bins, range=None):
+    '''
+    Count the number of values in each of a set of equal width bins.  The bin
+    for each value is found by a binary search of the bin edges (which is faster
+    than `np.histogram`, which sorts the data when it's given the edges) and the
+    values in each bin are counted by `np.bincount`.  A value equal to an edge
+    goes in the bin to the right of the edge, and the last bin includes its upper
+    edge, so the counts are the same as `np.histogram` and `plt.hist`.
+
+    Arguments:
+      data:  the values to count
+      bins:  the number of bins
+      range:  the lower and upper bin edges (default: the smallest and largest values)
+
+    Returns:
+      counts:  the number of values in each bin
+      edges:  the bin edges
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    if range is None:
+        range = (data.min(), data.max()) if len(data) else (0, 1)
+    lo, hi = range
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    edges = np.linspace(lo, hi, bins+1)
+    data = data[(data >= lo) & (data <= hi)]
+    idx = np.clip(np.searchsorted(edges, data, 'right') - 1, 0, bins-1)
+    counts = np.bincount(idx, minlength=bins)
+    return counts, edges
+
+def plot_histogram(ax, data, bins, range=None, rwidth=1, align='mid', **kwargs):
+    '''
+    Draw a histogram as a bar chart.  The bars are placed the same way `plt.hist`
+    places them, but the counts come from `histogram`.
+
+    Arguments:
+      ax:  the axes to draw on
+      data:  the values to count
+      bins:  the number of bins
+      range:  the lower and upper bin edges
+      rwidth:  the width of a bar, relative to the bin width
+      align:  'left' centers bars on the left bin edges, 'mid' centers them in the bins
+      kwargs:  additional arguments passed to `ax.bar`
+    '''
+    counts, edges = histogram(data, bins, range)
+    widths = np.diff(edges)
+    x = edges[:-1] if align == 'left' else edges[:-1] + widths/2
+    ax.bar(x, counts, width=widths*rwidth, **kwargs)
+
+def show(fig, args):
+    '''
+    Display a plot, or, if a file name was specified with --plot, save it 
+    in the file.
+
+    Arguments:
+      fig:  the figure to display
+      args:  command line arguments
+    '''
+    if args.plot:
+        fig.savefig(args.plot)
+        plt.close(fig)
+    else:
+        plt.show()
+
 def count_histogram(df, args):
     '''
     Use matplotlib to create and display at histogram of block sizes.
@@ -51,12 +116,12 @@ def count_histogram(df, args):
       args:  command line arguments
     '''
     fig, ax = plt.subplots()
-    plt.hist(df.blk_size, bins=10, rwidth=0.8, align='left', range=(1,100), label=args.chromosomes)
-    plt.title('Block Size')
-    plt.xlabel('Number of SNPs')
-    plt.ylabel('Number of Blocks')
-    plt.legend(handlelength=0)
-    plt.show()
+    plot_histogram(ax, df.blk_size, bins=10, rwidth=0.8, align='left', range=(1,100), label=args.chromosomes)
+    ax.set_title('Block Size')
+    ax.set_xlabel('Number of SNPs')
+    ax.set_ylabel('Number of Blocks')
+    ax.legend(handlelength=0)
+    show(fig, args)
 
 def length_histogram(df, args):
     '''
@@ -67,12 +132,12 @@ def length_histogram(df, args):
       args:  command line arguments
     '''
     fig, ax = plt.subplots()
-    plt.hist(df.blk_len, bins=10, rwidth=0.8, label=args.chromosomes)
-    plt.title('Block Length')
-    plt.xlabel('Length (bp)')
-    plt.ylabel('Number of Blocks')
-    plt.legend(handlelength=0)
-    plt.show()
+    plot_histogram(ax, df.blk_len, bins=10, rwidth=0.8, label=args.chromosomes)
+    ax.set_title('Block Length')
+    ax.set_xlabel('Length (bp)')
+    ax.set_ylabel('Number of Blocks')
+    ax.legend(handlelength=0)
+    show(fig, args)
 
 def location_histogram(df, args):
     '''
@@ -83,23 +148,27 @@ def location_histogram(df, args):
       args:  command line arguments
     '''
     fig, ax = plt.subplots()
-    plt.hist(df.blk_loc, bins=100, range=(0,1), label=args.chromosomes)
-    plt.title('Block Location')
-    plt.xlabel('Relative Position in the Chromosome')
-    plt.ylabel('Number of Blocks')
-    plt.legend(handlelength=0)
-    plt.show()
+    plot_histogram(ax, df.blk_loc, bins=100, range=(0,1), label=args.chromosomes)
+    ax.set_title('Block Location')
+    ax.set_xlabel('Relative Position in the Chromosome')
+    ax.set_ylabel('Number of Blocks')
+    ax.legend(handlelength=0)
+    show(fig, args)
 
 
 def visualize(args):
     '''
     Main function of the `vis` script.  Creates a SNPFilter object, saves
     filtering parameters found on the command line, loads and filters the
-    SNP data, generates a histogram.
+    SNP data, generates a histogram (displayed in a window, or saved in a
+    file if --plot was specified).
 
     Arguments:
       args:  command line arguments
     '''
+    # a plot that is only saved to a file doesn't need an interactive backend
+    if args.plot:
+        matplotlib.use('Agg')
     matplotlib.rcParams.update({'font.size': 12})
 
     dispatch = {
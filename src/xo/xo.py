@@ -12,64 +12,169 @@
 # to run one of the commands -- peak finder, viewer, or filter.
 
 import argparse
+import importlib
 import os
 import sys
 
 import logging
-from rich.logging import RichHandler
+import logging.handlers
 
-from .peaks import peak_finder
-from .gui import start_app
-from .vis import visualize, plot_commands
+# Default file names.  Use the environment variable for a file if there is
+# one (there will be when the program is run in a Docker container), otherwise
+# use the predefined name.
 
-def init_cli():
-    """
-    Use argparse to create the command line API.
+default_files = {
+    'snps': os.environ.get('XO_SNPS', 'BSP_TIGER.marker_dataframe.pickle.gzip'),
+    'intervals': os.environ.get('XO_INTERVALS', 'BSP_TIGER.intervals_dataframe.pickle.gzip'),
+    'peaks': os.environ.get('XO_PEAKS', 'peaks.csv'),
+    'save': os.environ.get('XO_SAVE', 'summary.csv'),
+}
 
-    Returns:
-        a Namespace object with values of the command line arguments. 
+# Default port for the GUI server
+
+GUI_PORT = 5006
+
+# Number of log messages saved before they are written, and the format
+# used to write them
+
+LOG_BUFFER_SIZE = 1024
+LOG_FORMATTER = logging.Formatter('{relativeCreated:4.0f} msec: {message}', style='{')
+
+def positive_int(s):
+    """
+    Convert a command line argument to an integer that is at least 1 (used as
+    the `type` of options that specify counts).
     """
-    snps_default = os.environ.get('XO_SNPS') or 'BSP_TIGER.marker_dataframe.pickle.gzip'
-    intervals_default = os.environ.get('XO_INTERVALS') or 'BSP_TIGER.intervals_dataframe.pickle.gzip'
-    peaks_default = os.environ.get('XO_PEAKS') or 'peaks.csv'
-    save_default = os.environ.get('XO_SAVE') or 'summary.csv'
+    n = int(s)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'{s} is not a positive integer')
+    return n
 
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers(
-        title = 'subcommands',
-        description = 'operation to perform'
-    )
+def add_peaks_options(peak_parser, defaults):
+    """
+    Define the options for the peaks command.
 
-    peak_parser = subparsers.add_parser('peaks', help='find peaks in the SNP data')
-    peak_parser.add_argument('--snps', metavar='F', default=snps_default, help='input (IGER marker) file')
-    peak_parser.add_argument('--output', metavar='F', default=peaks_default, help='output file')
+    Arguments:
+        peak_parser:  the parser for the command
+        defaults:  a dictionary with default file names
+    """
+    peak_parser.add_argument('--snps', metavar='F', default=defaults['snps'], help='input (IGER marker) file')
+    peak_parser.add_argument('--output', metavar='F', default=defaults['peaks'], help='output file')
     peak_parser.add_argument('--max_snps', metavar='N', type=int, default=1000, help="max number of SNPs in a block")
-    peak_parser.set_defaults(func=peak_finder)
+    peak_parser.add_argument('--workers', metavar='N', type=positive_int, help="number of chromosomes to process in parallel (default: one per CPU)")
+    peak_parser.set_defaults(cmnd='peaks')
 
-    gui_parser = subparsers.add_parser('gui', help='explore blocks of SNPs')
-    gui_parser.add_argument('--intervals', metavar='F', default=intervals_default, help='SNP summaries')
-    gui_parser.add_argument('--peaks', metavar='F', default=peaks_default, help='blocks saved by peaks.py')
-    gui_parser.add_argument('--port', metavar='N', type=int, default=5006, help='local port for the Panel server')
-    gui_parser.set_defaults(func=start_app)
+def add_gui_options(gui_parser, defaults):
+    """
+    Define the options for the gui command.
 
-    vis_parser = subparsers.add_parser('vis', help='visualizations based on filtered blocks')
+    Arguments:
+        gui_parser:  the parser for the command
+        defaults:  a dictionary with default file names
+    """
+    gui_parser.add_argument('--intervals', metavar='F', default=defaults['intervals'], help='SNP summaries')
+    gui_parser.add_argument('--peaks', metavar='F', default=defaults['peaks'], help='blocks saved by peaks.py')
+    gui_parser.add_argument('--port', metavar='N', type=int, default=GUI_PORT, help='local port for the Panel server')
+    gui_parser.set_defaults(cmnd='gui')
+
+def add_vis_options(vis_parser, defaults):
+    """
+    Define the options for the vis command.
+
+    Arguments:
+        vis_parser:  the parser for the command
+        defaults:  a dictionary with default file names
+    """
+    # the plot names are defined in the vis module, which imports matplotlib, so
+    # import it only when the options for this command are needed
+    from .vis import plot_commands
     vis_parser.add_argument('command', metavar='P', choices=plot_commands, help=f'type of plot to make {plot_commands}')
-    vis_parser.add_argument('--peaks', metavar='F', default=peaks_default, help='blocks saved by peaks.py')
+    vis_parser.add_argument('--peaks', metavar='F', default=defaults['peaks'], help='blocks saved by peaks.py')
     vis_parser.add_argument('--chromosomes', metavar='P', default='BSP.*', help='chromosome name pattern')
     vis_parser.add_argument('--size', metavar='N', nargs=2, type=int, default=(0,100), help='block size range (#SNPs)')
     vis_parser.add_argument('--length', metavar='N', nargs=2, type=int, default=(0,10000), help='block length range (bp)')
     vis_parser.add_argument('--coverage', metavar='N', type=int, help='minimum coverage')
     vis_parser.add_argument('--match', action='store_true', help='require genome match')
-    vis_parser.add_argument('--save', metavar='F', default=save_default, help='write summary dataframe to this file')
-    vis_parser.set_defaults(func=visualize)
+    vis_parser.add_argument('--save', metavar='F', default=defaults['save'], help='write summary dataframe to this file')
+    vis_parser.add_argument('--plot', metavar='F', help='save the plot in this file instead of displaying it')
+    vis_parser.set_defaults(cmnd='vis')
 
-    post_parser = subparsers.add_parser('post', help='postprocessing of filtered blocks')
-    post_parser.add_argument('--peaks', metavar='F', default=peaks_default, help='blocks saved by peaks.py')
-    post_parser.set_defaults(func=post)
+def add_post_options(post_parser, defaults):
+    """
+    Define the options for the post command.
+
+    Arguments:
+        post_parser:  the parser for the command
+        defaults:  a dictionary with default file names
+    """
+    post_parser.add_argument('--peaks', metavar='F', default=defaults['peaks'], help='blocks saved by peaks.py')
+    post_parser.set_defaults(cmnd='post')
+
+# The commands, in the order they are listed in the help message.  For each
+# command there is a description (for the help message), the function that 
+# defines its options, and the function that implements it, specified by
+# module and function name.  A module is imported only when its command is 
+# run, so (for example) the peak finder doesn't have to load Panel.
+
+commands = {
+    'peaks': ('find peaks in the SNP data',              add_peaks_options, '.peaks', 'peak_finder'),
+    'gui':   ('explore blocks of SNPs',                  add_gui_options,   '.gui',   'start_app'),
+    'vis':   ('visualizations based on filtered blocks', add_vis_options,   '.vis',   'visualize'),
+    'post':  ('postprocessing of filtered blocks',       add_post_options,  '.xo',    'post'),
+}
+
+def sniff_command(argv):
+    """
+    Find the name of the command on the command line.  The top level parser
+    has no options other than --help, so the command has to be the first
+    argument.
+
+    Arguments:
+        argv:  the command line arguments
+
+    Returns:
+        the command name, or None if the first argument is not a command
+    """
+    if len(argv) > 1 and argv[1] in commands:
+        return argv[1]
+    return None
+
+def init_cli():
+    """
+    Use argparse to create the command line API.  Every command has a parser, 
+    but options are only defined for the command found on the command line (the
+    others are only needed for the help message or to report an unknown command,
+    and those just need the name and description of each command).  The most
+    common command, `xo gui` with no options, doesn't need a parser at all; the
+    arguments are just the default values.
+
+    Returns:
+        a Namespace object with values of the command line arguments, or None
+        if there are no arguments (after printing the help message).
+    """
+    if sys.argv[1:] == ['gui']:
+        return argparse.Namespace(
+            cmnd='gui', 
+            intervals=default_files['intervals'], 
+            peaks=default_files['peaks'], 
+            port=GUI_PORT,
+        )
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(
+        title = 'subcommands',
+        description = 'operation to perform'
+    )
+
+    cmnd = sniff_command(sys.argv)
+    for name, (description, add_options, _, _) in commands.items():
+        cmnd_parser = subparsers.add_parser(name, help=description)
+        if name == cmnd:
+            add_options(cmnd_parser, default_files)
 
     if len(sys.argv) == 1:
         parser.print_help()
-        exit()
+        return None
 
     return parser.parse_args()
 
@@ -77,15 +182,49 @@ def setup_logging(args):
     """
     Configure the logging modile.  Uncomment one of the first three
     lines to define the logging level.
+
+    Messages are written to stdout by a plain stream handler.  Set the
+    environment variable XO_PRETTY_LOGS to use Rich to format messages
+    (which is much slower, and means Rich has to be imported).
+
+    Messages are saved in a buffer and written in batches, when the buffer is
+    full, when a warning or error is logged, and when the program exits (the
+    logging module closes all handlers at exit).  Messages are not buffered
+    for commands that wait for the user:  the GUI (the server runs until it is
+    killed) and `vis` without --plot (the plot window stays open until the user
+    closes it).  Buffering can be turned off for other commands by setting
+    XO_LOG_UNBUFFERED.
+
+    If logging has already been configured (e.g. when `main` is called more than
+    once in a notebook) the existing configuration is kept, unless XO_RESET_LOGGING
+    is set, in which case the old handlers are replaced.
     """
+    reset = bool(os.environ.get('XO_RESET_LOGGING'))
+    if logging.getLogger().handlers and not reset:
+        return
     level = logging.INFO
     # level = logging.DEBUG
     # level = logging.WARNING
+    if os.environ.get('XO_PRETTY_LOGS'):
+        from rich.logging import RichHandler
+        handler = RichHandler(markup=True)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    # the formatter has to be attached to the handler that does the writing,
+    # not the buffer
+    handler.setFormatter(LOG_FORMATTER)
+    interactive = args.cmnd == 'gui' or (args.cmnd == 'vis' and not args.plot)
+    if not interactive and not os.environ.get('XO_LOG_UNBUFFERED'):
+        handler = logging.handlers.MemoryHandler(
+            LOG_BUFFER_SIZE, 
+            flushLevel=logging.WARNING, 
+            target=handler, 
+            flushOnClose=True,
+        )
     logging.basicConfig(
         level=level,
-        style='{',
-        format='{relativeCreated:4.0f} msec: {message}',
-        handlers = [RichHandler(markup=True)],
+        handlers = [handler],
+        force = reset,
     )
 
 def post(args):
@@ -93,10 +232,15 @@ def post(args):
 
 def main():
     """
-    The argument parser associates a function with each script name, all
-    we need to do here is call that function.
+    The argument parser saves the name of the command, use it to look up 
+    the function that implements the command (importing its module
+    at this point), then call that function.
     """
     args = init_cli()
+    if args is None:
+        return
     setup_logging(args)
-    args.func(args)
+    _, _, module, name = commands[args.cmnd]
+    func = getattr(importlib.import_module(module, __package__), name)
+    func(args)
 